@@ -24,18 +24,43 @@ import pysmt.typing as types
 import pysmt.operators as op
 import pysmt.environment
 
+_THEORY_PLACEHOLDER = "__Placeholder__"
+_TRUE_CNF = frozenset()
+_FALSE_CNF = frozenset([frozenset()])
+
+# Polarities of a subformula w.r.t. the formula being converted
+_POSITIVE = 1
+_NEGATIVE = 2
+_BOTH = _POSITIVE | _NEGATIVE
+_FLIPPED = {_POSITIVE: _NEGATIVE, _NEGATIVE: _POSITIVE, _BOTH: _BOTH}
+
+
 class CNFizer(DagWalker):
 
-    THEORY_PLACEHOLDER = "__Placeholder__"
+    THEORY_PLACEHOLDER = _THEORY_PLACEHOLDER
 
-    TRUE_CNF = frozenset()
-    FALSE_CNF = frozenset([frozenset()])
+    TRUE_CNF = _TRUE_CNF
+    FALSE_CNF = _FALSE_CNF
 
     def __init__(self, environment=None):
         DagWalker.__init__(self, environment)
         self.mgr = self.env.formula_manager
+        # Constants are unique FNodes of the formula manager, thus they
+        # are bound once and compared by identity
+        self._true = self.mgr.TRUE()
+        self._false = self.mgr.FALSE()
         self._introduced_variables = {}
         self._cnf_pieces = {}
+        self._negated = {}
+        self._clauses = []
+        self._has_constants = False
+        self._polarity = {}
+        # All theory terms and relations are handled in the same way:
+        # they are mapped to shared functions to keep dispatch simple
+        self.set_function(self.walk_theory_op, op.REAL_CONSTANT,
+                          op.INT_CONSTANT, op.PLUS, op.MINUS, op.TIMES,
+                          op.TOREAL)
+        self.set_function(self.walk_theory_relation, op.EQUALS, op.LE, op.LT)
 
     def _key_var(self, formula):
         if formula in self._introduced_variables:
@@ -43,6 +68,132 @@ class CNFizer(DagWalker):
         else:
             res = self.mgr.FreshSymbol()
             self._introduced_variables[formula] = res
+            # The negation of a fresh symbol needs no simplification
+            self._negated[res] = self.mgr.Not(res)
+        return res
+
+    def _neg(self, formula):
+        if formula in self._negated:
+            res = self._negated[formula]
+        else:
+            res = self.mgr.Not(formula).simplify()
+            if res.is_bool_constant():
+                # The negation of some theory atoms simplifies to a
+                # constant (e.g., Not(1 <= 2)). These are not cached,
+                # so that every use is recorded in _has_constants.
+                self._has_constants = True
+            else:
+                self._negated[formula] = res
+        return res
+
+    def _get_polarities(self, formulae):
+        """Returns the polarity of each subformula of the given formulae.
+
+        The formulae are assumed to occur positively. Only the
+        polarity below Boolean connectives is tracked: the children of
+        all other nodes are considered to occur with both polarities.
+        """
+        # Post-order visit of the DAG: its reverse is a topological
+        # order in which each node follows all its parents
+        order = []
+        seen = set()
+        stack = [(False, f) for f in formulae]
+        while stack:
+            (was_expanded, f) = stack.pop()
+            if was_expanded:
+                order.append(f)
+            elif f not in seen:
+                seen.add(f)
+                stack.append((True, f))
+                for s in f.args():
+                    if s not in seen:
+                        stack.append((False, s))
+
+        polarity = dict((f, _POSITIVE) for f in formulae)
+        for f in reversed(order):
+            p = polarity[f]
+            nt = f.node_type()
+            if nt == op.AND or nt == op.OR:
+                children = [(s, p) for s in f.args()]
+            elif nt == op.NOT:
+                children = [(f.arg(0), _FLIPPED[p])]
+            elif nt == op.IMPLIES:
+                children = [(f.arg(0), _FLIPPED[p]), (f.arg(1), p)]
+            elif nt == op.ITE:
+                children = [(f.arg(0), _BOTH), (f.arg(1), p), (f.arg(2), p)]
+            else:
+                children = [(s, _BOTH) for s in f.args()]
+            for s, q in children:
+                polarity[s] = polarity.get(s, 0) | q
+        return polarity
+
+    def _walk(self, formula):
+        """Post-order iterative walk of the DAG of formula.
+
+        This behaves like DagWalker.iter_walk, but does not need to
+        handle keyword arguments and custom memoization keys.
+        """
+        memoization = self.memoization
+        functions = self.functions
+        stack = [(False, formula)]
+        while stack:
+            (was_expanded, f) = stack.pop()
+            if f in memoization:
+                continue
+            if was_expanded:
+                try:
+                    fun = functions[f.node_type()]
+                except KeyError:
+                    fun = self.walk_error
+                args = [memoization[s] for s in f.args()]
+                memoization[f] = fun(f, args=args)
+            else:
+                stack.append((True, f))
+                for s in f.args():
+                    if s not in memoization:
+                        stack.append((False, s))
+        return memoization[formula]
+
+    def _get_clauses(self, formula):
+        """Returns the clauses of an Equisatisfiable CNF of formula.
+
+        Clauses are returned as sequences of literals, none of which is
+        TRUE or FALSE. If the CNF is trivially FALSE, returns None.
+        """
+        # The clauses of each subformula are collected in a fresh pool,
+        # hence the memoization of previous calls cannot be reused
+        self.memoization.clear()
+        self._clauses = []
+        self._has_constants = False
+        # Top-level conjuncts are asserted directly as unit clauses,
+        # without introducing a key variable for the root
+        conjuncts = list(conjunctive_partition(formula))
+        self._polarity = self._get_polarities(conjuncts)
+        for conjunct in conjuncts:
+            tl = self._walk(conjunct)
+            self._clauses.append((tl,))
+        clauses = self._clauses
+        self._clauses = []
+        self._polarity = {}
+
+        if not self._has_constants:
+            # Constants can only come from Boolean constants in the
+            # formula or from negations simplified to a constant: both
+            # set _has_constants, thus no literal is TRUE or FALSE here
+            return clauses
+
+        TRUE, FALSE = self._true, self._false
+        res = []
+        for clause in clauses:
+            if TRUE in clause:
+                # Prune clauses that are trivially TRUE
+                continue
+            if FALSE in clause:
+                # Prune FALSE literals
+                clause = [lit for lit in clause if lit is not FALSE]
+                if not clause:
+                    return None
+            res.append(clause)
         return res
 
     def convert(self, formula):
@@ -50,34 +201,36 @@ class CNFizer(DagWalker):
 
         Returns a set of clauses: a set of set of literals.
         """
-        tl, _cnf = self.walk(formula)
-        res = [frozenset([tl])]
-        for clause in _cnf:
-            if len(clause) == 0:
-                return CNFizer.FALSE_CNF
-            simp = []
-            for lit in clause:
-                if lit.is_true():
-                    # Prune clauses that are trivially TRUE
-                    simp = None
-                    break
-                elif not lit.is_false():
-                    # Prune FALSE literals
-                    simp.append(lit)
-            if simp:
-                res.append(frozenset(simp))
-        return frozenset(res)
+        clauses = self._get_clauses(formula)
+        if clauses is None:
+            return _FALSE_CNF
+        # Each clause is turned into a frozenset exactly once
+        return frozenset(map(frozenset, clauses))
 
     def convert_as_formula(self, formula):
         """Convert formula into an Equisatisfiable CNF.
 
         Returns an FNode.
         """
-        lsts = self.convert(formula)
-
+        # The clauses are turned directly into FNodes, without building
+        # the set of sets returned by convert
+        clauses = self._get_clauses(formula)
+        if clauses is None:
+            return self._false
+
+        # Duplicate literals and clauses are removed, as in convert
+        seen = set()
         conj = []
-        for clause in lsts:
-            conj.append(self.mgr.Or(clause))
+        for clause in clauses:
+            clause = frozenset(clause)
+            if clause in seen:
+                continue
+            seen.add(clause)
+            if len(clause) == 1:
+                # Unit clauses do not need an Or
+                conj.append(next(iter(clause)))
+            else:
+                conj.append(self.mgr.Or(clause))
         return self.mgr.And(conj)
 
     def printer(self, _cnf):
@@ -85,147 +238,155 @@ class CNFizer(DagWalker):
         return
 
     def serialize(self, _cnf):
-        clauses = []
-        for clause in _cnf:
-            clauses +=[" { " + " ".join(str(lit) for lit in clause) + "} "]
-        res = ["{"] + clauses + ["}"]
-        return "".join(res)
-
-
-
-    def walk_forall(self, formula, args, **kwargs):
+        return "{" + "".join(" { " + " ".join(map(str, clause)) + "} "
+                             for clause in _cnf) + "}"
+
+
+
+    # Each walk_* function returns the literal representing the
+    # formula, and appends the clauses that define it to
+    # self._clauses.  Since the walk is memoized, the clauses of a
+    # shared subformula are added to the pool exactly once. Clauses
+    # are tuples of literals, turned into frozensets only once, when
+    # convert or convert_as_formula builds its result.
+    #
+    # Every clause contains the key variable of the subformula that
+    # produced it: clauses coming from different subformulas are never
+    # equal, thus there is no need to intern them. Duplicates produced
+    # by a single subformula (e.g., repeated children of an And) are
+    # removed when the result is built.
+    #
+    # Following Plaisted and Greenbaum, only the implication k -> f is
+    # encoded for a subformula f that occurs only positively, and only
+    # f -> k if it occurs only negatively. Subformulas without a
+    # known polarity get the full encoding.
+
+    def walk_forall(self, formula, args):
         raise NotImplementedError("CNFizer does not support quantifiers")
 
-    def walk_exists(self, formula, args, **kwargs):
+    def walk_exists(self, formula, args):
         raise NotImplementedError("CNFizer does not support quantifiers")
 
-    def walk_and(self, formula, args, **kwargs):
-        if len(args) == 1:
+    def walk_and(self, formula, args):
+        TRUE, FALSE = self._true, self._false
+        if FALSE in args:
+            return FALSE
+        args = [a for a in args if a is not TRUE]
+        if len(args) == 0:
+            return TRUE
+        elif len(args) == 1:
             return args[0]
 
         k = self._key_var(formula)
-        _cnf = [frozenset([k] + [self.mgr.Not(a).simplify() for a,_ in args])]
-        for a,c in args:
-            _cnf.append(frozenset([a, self.mgr.Not(k)]))
-            for clause in c:
-                _cnf.append(clause)
-        return k, frozenset(_cnf)
-
-    def walk_or(self, formula, args, **kwargs):
-        if len(args) == 1:
+        not_k = self._neg(k)
+        p = self._polarity.get(formula, _BOTH)
+        if p & _POSITIVE:
+            self._clauses.extend([(a, not_k) for a in args])
+        if p & _NEGATIVE:
+            self._clauses.append((k,) + tuple(map(self._neg, args)))
+        return k
+
+    def walk_or(self, formula, args):
+        TRUE, FALSE = self._true, self._false
+        if TRUE in args:
+            return TRUE
+        args = [a for a in args if a is not FALSE]
+        if len(args) == 0:
+            return FALSE
+        elif len(args) == 1:
             return args[0]
-        k = self._key_var(formula)
-        _cnf = [frozenset([self.mgr.Not(k)] + [a for a,_ in args])]
-        for a,c in args:
-            _cnf.append(frozenset([k, self.mgr.Not(a)]))
-            for clause in c:
-                _cnf.append(clause)
-        return k, frozenset(_cnf)
 
-    def walk_not(self, formula, args, **kwargs):
-        a, _cnf = args[0]
-        if a.is_true():
-            return self.mgr.FALSE(), CNFizer.TRUE_CNF
-        elif a.is_false():
-            return self.mgr.TRUE(), CNFizer.TRUE_CNF
+        k = self._key_var(formula)
+        not_k = self._neg(k)
+        p = self._polarity.get(formula, _BOTH)
+        if p & _POSITIVE:
+            self._clauses.append((not_k,) + tuple(args))
+        if p & _NEGATIVE:
+            self._clauses.extend([(k, not_a)
+                                  for not_a in map(self._neg, args)])
+        return k
+
+    def walk_not(self, formula, args):
+        a = args[0]
+        if a is self._true:
+            return self._false
+        elif a is self._false:
+            return self._true
         else:
             k = self._key_var(formula)
-            return k, _cnf | frozenset([frozenset([self.mgr.Not(k),
-                                                  self.mgr.Not(a).simplify()]),
-                                       frozenset([k, a])])
+            p = self._polarity.get(formula, _BOTH)
+            if p & _POSITIVE:
+                self._clauses.append((self._neg(k), self._neg(a)))
+            if p & _NEGATIVE:
+                self._clauses.append((k, a))
+            return k
 
-    def walk_implies(self, formula,  args, **kwargs):
-        a, cnf_a = args[0]
-        b, cnf_b = args[1]
+    def walk_implies(self, formula, args):
+        a, b = args
 
         k = self._key_var(formula)
-        not_a = self.mgr.Not(a).simplify()
-        not_b = self.mgr.Not(b).simplify()
-        not_k = self.mgr.Not(k)
-
-        return k, (cnf_a | cnf_b | frozenset([frozenset([not_a, b, not_k]),
-                                              frozenset([a, k]),
-                                              frozenset([not_b, k])]))
+        p = self._polarity.get(formula, _BOTH)
+        if p & _POSITIVE:
+            self._clauses.append((self._neg(a), b, self._neg(k)))
+        if p & _NEGATIVE:
+            self._clauses.extend([(a, k),
+                                  (self._neg(b), k)])
+        return k
 
-    def walk_iff(self, formula, args, **kwargs):
-        a, cnf_a = args[0]
-        b, cnf_b = args[1]
+    def walk_iff(self, formula, args):
+        a, b = args
 
         k = self._key_var(formula)
-        not_a = self.mgr.Not(a).simplify()
-        not_b = self.mgr.Not(b).simplify()
-        not_k = self.mgr.Not(k)
+        not_a = self._neg(a)
+        not_b = self._neg(b)
+        not_k = self._neg(k)
 
-        return k, (cnf_a | cnf_b | frozenset([frozenset([not_a, not_b, k]),
-                                              frozenset([not_a, b, not_k]),
-                                              frozenset([a, not_b, not_k]),
-                                              frozenset([a, b, k])]))
+        self._clauses.extend([(not_a, not_b, k),
+                              (not_a, b, not_k),
+                              (a, not_b, not_k),
+                              (a, b, k)])
+        return k
 
-    def walk_symbol(self, formula, **kwargs):
+    def walk_symbol(self, formula, args):
         if formula.is_symbol(types.BOOL):
-            return formula, CNFizer.TRUE_CNF
+            return formula
         else:
-            return CNFizer.THEORY_PLACEHOLDER
+            return _THEORY_PLACEHOLDER
 
-    def walk_function(self, formula, **kwargs):
+    def walk_function(self, formula, args):
         ty = formula.function_symbol().symbol_type()
         if ty.return_type.is_bool_type():
-            return formula, CNFizer.TRUE_CNF
-        else:
-            return CNFizer.THEORY_PLACEHOLDER
-
-    def walk_real_constant(self, formula, **kwargs):
-        return CNFizer.THEORY_PLACEHOLDER
-
-    def walk_bool_constant(self, formula, **kwargs):
-        if formula.is_true():
-            return formula, CNFizer.TRUE_CNF
+            return formula
         else:
-            return formula, CNFizer.TRUE_CNF
-
-    def walk_int_constant(self, formula, **kwargs):
-        return CNFizer.THEORY_PLACEHOLDER
+            return _THEORY_PLACEHOLDER
 
-    def walk_plus(self, formula, **kwargs):
-        return CNFizer.THEORY_PLACEHOLDER
-
-    def walk_minus(self, formula, **kwargs):
-        return CNFizer.THEORY_PLACEHOLDER
-
-    def walk_times(self, formula, **kwargs):
-        return CNFizer.THEORY_PLACEHOLDER
-
-    def walk_equals(self, formula, args, **kwargs):
-        assert all(a == CNFizer.THEORY_PLACEHOLDER for a in args)
-        return formula, CNFizer.TRUE_CNF
+    def walk_bool_constant(self, formula, args):
+        self._has_constants = True
+        return formula
 
-    def walk_le(self, formula, args, **kwargs):
-        assert all(a == CNFizer.THEORY_PLACEHOLDER for a in args)
-        return formula, CNFizer.TRUE_CNF
+    def walk_theory_op(self, formula, args):
+        return _THEORY_PLACEHOLDER
 
-    def walk_lt(self, formula, args, **kwargs):
-        assert all(a == CNFizer.THEORY_PLACEHOLDER for a in args), str(args)
-        return formula, CNFizer.TRUE_CNF
+    def walk_theory_relation(self, formula, args):
+        assert all(a is _THEORY_PLACEHOLDER for a in args), str(args)
+        return formula
 
-    def walk_ite(self, formula, args, **kwargs):
-        if any(a == CNFizer.THEORY_PLACEHOLDER for a in args):
-            return CNFizer.THEORY_PLACEHOLDER
+    def walk_ite(self, formula, args):
+        if any(a is _THEORY_PLACEHOLDER for a in args):
+            return _THEORY_PLACEHOLDER
         else:
-            (i,cnf_i),(t,cnf_t),(e,cnf_e) = args
+            i,t,e = args
             k = self._key_var(formula)
-            not_i = self.mgr.Not(i).simplify()
-            not_t = self.mgr.Not(t).simplify()
-            not_e = self.mgr.Not(e).simplify()
-            not_k = self.mgr.Not(k)
-
-            return k, (cnf_i | cnf_t | cnf_e |
-                       frozenset([frozenset([not_i, not_t, k]),
-                                  frozenset([not_i, t, not_k]),
-                                  frozenset([i, not_e, k]),
-                                  frozenset([i, e, not_k])]))
-
-    def walk_toreal(self, formula, **kwargs):
-        return CNFizer.THEORY_PLACEHOLDER
+            not_i = self._neg(i)
+            p = self._polarity.get(formula, _BOTH)
+            if p & _POSITIVE:
+                not_k = self._neg(k)
+                self._clauses.extend([(not_i, t, not_k),
+                                      (i, e, not_k)])
+            if p & _NEGATIVE:
+                self._clauses.extend([(not_i, self._neg(t), k),
+                                      (i, self._neg(e), k)])
+            return k
 
 
 class NNFizer(DagWalker):
@@ -16,10 +16,13 @@
 #   limitations under the License.
 #
 import os
+import time
 from nose.plugins.attrib import attr
 
 from pysmt.shortcuts import Implies, is_sat, reset_env, Symbol, Iff
+from pysmt.shortcuts import TRUE, FALSE, And, Or, Not, LE, LT, Equals, Int
 from pysmt.rewritings import CNFizer
+from pysmt.typing import INT
 from pysmt.logics import QF_BOOL, QF_LRA, QF_LIA, QF_UFLIRA
 from pysmt.test import TestCase, skipIfNoSolverForLogic, main
 from pysmt.test.examples import EXAMPLE_FORMULAS
@@ -100,5 +103,79 @@ class TestCnf(TestCase):
 
         self.assertValid(Implies(cnf, f), logic=QF_BOOL)
 
+    def test_shared_dag(self):
+        # Every level refers twice to the previous one: the CNF must be
+        # linear in the size of the DAG, not in the size of the tree
+        depth = 40
+        f = Symbol("x0")
+        for i in range(1, depth + 1):
+            x, y = Symbol("x%d" % i), Symbol("y%d" % i)
+            f = And(Or(f, x), Or(f, Not(y)))
+
+        conv = CNFizer()
+        start = time.time()
+        cnf = conv.convert(f)
+        self.assertLess(time.time() - start, 5)
+        self.assertLess(len(cnf), 12 * depth)
+
+    def test_constants(self):
+        conv = CNFizer()
+        self.assertEqual(conv.convert(TRUE()), CNFizer.TRUE_CNF)
+        self.assertEqual(conv.convert(FALSE()), CNFizer.FALSE_CNF)
+
+        a, b = Symbol("a"), Symbol("b")
+        self.assertEqual(conv.convert(And(a, FALSE())), CNFizer.FALSE_CNF)
+        self.assertEqual(conv.convert(Or(a, TRUE())), CNFizer.TRUE_CNF)
+        self.assertEqual(conv.convert(And(a, TRUE())), conv.convert(a))
+        self.assertEqual(conv.convert(Or(FALSE(), Or(a, b))),
+                         conv.convert(Or(a, b)))
+
+    def test_theory_atoms_negated_to_constants(self):
+        x, y = Symbol("x"), Symbol("y")
+        e = Symbol("e", INT)
+        conv = CNFizer()
+        for f in [Iff(y, And(x, LE(Int(1), Int(2)))),
+                  Or(y, Not(Equals(e, e))),
+                  Or(y, And(x, LT(Int(2), Int(1)))),
+                  Iff(y, Or(x, LT(Int(2), Int(1))))]:
+            # Converting twice also exercises the cached negations
+            for _ in range(2):
+                cnf = conv.convert(f)
+                for clause in cnf:
+                    self.assertTrue(len(clause) > 0)
+                    for lit in clause:
+                        self.assertFalse(lit.is_constant(), (f, cnf))
+
+    def test_top_level_conjuncts(self):
+        a, b, c = (Symbol(x) for x in "abc")
+        conv = CNFizer()
+        cnf = conv.convert(And(a, And(b, c)))
+        self.assertEqual(cnf, frozenset([frozenset([a]),
+                                         frozenset([b]),
+                                         frozenset([c])]))
+
+    def test_polarity(self):
+        a, b, c = (Symbol(x) for x in "abc")
+        conv = CNFizer()
+        # Both subformulas occur only positively: one unit clause, plus
+        # one implication from the key variable of each subformula
+        cnf = conv.convert(Or(a, And(b, c)))
+        self.assertEqual(len(cnf), 4)
+        # Under an Iff, both directions are needed
+        cnf = conv.convert(Iff(a, And(b, c)))
+        self.assertEqual(len(cnf), 8)
+
+    def test_as_formula_no_duplicates(self):
+        a, b, c = (Symbol(x) for x in "abc")
+        conv = CNFizer()
+        for f in [Or(c, And(a, a, b)), Iff(c, And(a, b, a))]:
+            cnf = conv.convert_as_formula(f)
+            self.assertTrue(cnf.is_and())
+            self.assertEqual(len(set(cnf.args())), len(cnf.args()))
+            for clause in cnf.args():
+                if clause.is_or():
+                    self.assertEqual(len(set(clause.args())),
+                                     len(clause.args()))
+
 if __name__ == '__main__':
     main()